@@ -1,9 +1,25 @@
+import bisect
+import struct
+import logging
 import contextlib
 
 import envi
 import viv_utils
 
 
+# the number of stack slots searched for a valid return address
+RETURN_ADDRESS_SEARCH_SLOTS = 4
+
+# maps from pointer size to the precompiled format of the return address search window
+_RETURN_ADDRESS_WINDOW_FORMATS = {
+    4: struct.Struct("<%dI" % RETURN_ADDRESS_SEARCH_SLOTS),
+    8: struct.Struct("<%dQ" % RETURN_ADDRESS_SEARCH_SLOTS),
+}
+
+# the eight dwords from esp-0x10 through esp+0xc
+_STACK_DUMP_FORMAT = struct.Struct("<8I")
+
+
 class ApiMonitor(viv_utils.emulator_drivers.Monitor):
     '''
     The ApiMonitor observes emulation and cleans up API function returns.
@@ -12,10 +28,16 @@ class ApiMonitor(viv_utils.emulator_drivers.Monitor):
     def __init__(self, vw, function_index):
         viv_utils.emulator_drivers.Monitor.__init__(self, vw)
         self.function_index = function_index
+        # maps from function start to the set of valid return addresses
+        self._retva_cache = {}
+        # indexes of DUMP_REGISTERS in the emulator's register context,
+        # resolved the first time the state is dumped.
+        self._dump_register_indexes = None
 
     def apicall(self, emu, op, pc, api, argv):
         # overridden from Monitor
-        self.d("apicall: %s %s %s %s %s", emu, op, pc, api, argv)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self.d("apicall: %s %s %s %s %s", emu, op, pc, api, argv)
 
     def prehook(self, emu, op, startpc):
         # overridden from Monitor
@@ -37,7 +59,10 @@ class ApiMonitor(viv_utils.emulator_drivers.Monitor):
         on the stack or raises an Exception if no valid return address is found.
         '''
         function_start = self.function_index[op.va]
-        return_addresses = self._get_return_vas(emu, function_start)
+        return_addresses = self._retva_cache.get(function_start)
+        if return_addresses is None:
+            return_addresses = self._get_return_vas(emu, function_start)
+            self._retva_cache[function_start] = return_addresses
 
         if op.opers:
             # adjust stack in case of `ret imm16` instruction
@@ -54,15 +79,17 @@ class ApiMonitor(viv_utils.emulator_drivers.Monitor):
 
     def _get_return_vas(self, emu, function_start):
         '''
-        Get the list of valid addresses to which a function should return.
+        Get the set of valid addresses to which a function should return.
+
+        :rtype: frozenset[int]
         '''
-        return_vas = []
+        return_vas = set()
         callers = self._vw.getCallers(function_start)
         for caller in callers:
             call_op = emu.parseOpcode(caller)
             return_va = call_op.va + call_op.size
-            return_vas.append(return_va)
-        return return_vas
+            return_vas.add(return_va)
+        return frozenset(return_vas)
 
     def _fix_return(self, emu, return_address, return_addresses):
         '''
@@ -71,13 +98,14 @@ class ApiMonitor(viv_utils.emulator_drivers.Monitor):
         Modify program counter and stack pointer, so the emulator does not return to a garbage address.
         '''
         self.dumpStack(emu)
-        NUM_ADDRESSES = 4
         pointer_size = emu.getPointerSize()
-        STACK_SEARCH_WINDOW = pointer_size * NUM_ADDRESSES
         esp = emu.getStackCounter()
-        for offset in xrange(0, STACK_SEARCH_WINDOW, pointer_size):
-            ret_va_candidate = self.getStackValue(emu, offset)
+        # read the whole search window at once, rather than one stack value at a time
+        window_format = _RETURN_ADDRESS_WINDOW_FORMATS[pointer_size]
+        ret_va_candidates = window_format.unpack(emu.readMemory(esp, window_format.size))
+        for i, ret_va_candidate in enumerate(ret_va_candidates):
             if ret_va_candidate in return_addresses:
+                offset = i * pointer_size
                 emu.setProgramCounter(ret_va_candidate)
                 emu.setStackCounter(esp + offset + pointer_size)
                 self._logger.debug("Returning to 0x%08X, adjusted stack:", ret_va_candidate)
@@ -92,23 +120,31 @@ class ApiMonitor(viv_utils.emulator_drivers.Monitor):
         Convenience debugging routine for showing
          state current state of the stack.
         '''
+        if not self._logger.isEnabledFor(logging.DEBUG):
+            return
+
         esp = emu.getStackCounter()
+        stack_values = _STACK_DUMP_FORMAT.unpack(emu.readMemory(esp - 16, _STACK_DUMP_FORMAT.size))
         stack_str = ""
-        for i in xrange(16, -16, -4):
+        for i, stack_value in zip(range(16, -16, -4), stack_values):
             if i == 0:
                 sp = "<= SP"
             else:
                 sp = "%02x" % (-i)
-            stack_str = "%s\n0x%08x - 0x%08x %s" % (stack_str, (esp - i), self.getStackValue(emu, -i), sp)
+            stack_str = "%s\n0x%08x - 0x%08x %s" % (stack_str, (esp - i), stack_value, sp)
         self.d(stack_str)
 
+    DUMP_REGISTERS = ("eip", "esp", "eax", "ebx", "ecx", "edx")
+
     def dumpState(self, emu):
-        self.i("eip: 0x%x", emu.getRegisterByName("eip"))
-        self.i("esp: 0x%x", emu.getRegisterByName("esp"))
-        self.i("eax: 0x%x", emu.getRegisterByName("eax"))
-        self.i("ebx: 0x%x", emu.getRegisterByName("ebx"))
-        self.i("ecx: 0x%x", emu.getRegisterByName("ecx"))
-        self.i("edx: 0x%x", emu.getRegisterByName("edx"))
+        if not self._logger.isEnabledFor(logging.INFO):
+            return
+
+        if self._dump_register_indexes is None:
+            self._dump_register_indexes = [emu.getRegisterIndex(name) for name in self.DUMP_REGISTERS]
+
+        for name, index in zip(self.DUMP_REGISTERS, self._dump_register_indexes):
+            self.i("%s: 0x%x", name, emu.getRegister(index))
 
         self.dumpStack(emu)
 
@@ -123,13 +159,22 @@ def pointerSize(emu):
     return emu.imem_psize
 
 
+# maps from pointer size to the precompiled format of a stack element
+_STACK_ELEMENT_FORMATS = {
+    4: struct.Struct("<I"),
+    8: struct.Struct("<Q"),
+}
+
+
 def popStack(emu):
     '''
     Remove the element at the top of the stack.
     :rtype: int
     '''
-    v = emu.readMemoryFormat(emu.getStackCounter(), "<P")[0]
-    emu.setStackCounter(emu.getStackCounter() + pointerSize(emu))
+    fmt = _STACK_ELEMENT_FORMATS[pointerSize(emu)]
+    sp = emu.getStackCounter()
+    v = fmt.unpack(emu.readMemory(sp, fmt.size))[0]
+    emu.setStackCounter(sp + fmt.size)
     return v
 
 
@@ -138,55 +183,192 @@ class GetProcessHeapHook(viv_utils.emulator_drivers.Hook):
     Hook and handle calls to GetProcessHeap, returning 0.
     '''
 
+    CALLNAMES = frozenset(["kernel32.GetProcessHeap"])
+
     def hook(self, callname, emu, callconv, api, argv):
-        if callname == "kernel32.GetProcessHeap":
+        if callname in self.CALLNAMES:
             # nop
             callconv.execCallReturn(emu, 0, len(argv))
             return True
         raise viv_utils.emulator_drivers.UnsupportedFunction()
 
 
+PAGE_SIZE = 0x1000
+_PAGE_MASK = ~(PAGE_SIZE - 1)
+
+
 def round(i, size):
     '''
     Round `i` to the nearest greater-or-equal-to multiple of `size`.
 
+    `size` must be a power of two.
+
     :type i: int
     :type size: int
     :rtype: int
     '''
-    if i % size == 0:
-        return i
-    return i + (i - (i % size))
+    return (i + size - 1) & ~(size - 1)
+
+
+class HeapState(object):
+    '''
+    The "heap" address space handed out by the allocation hooks.
+    Hooks that share a HeapState never return overlapping allocations.
+    Freed allocations are merged with adjacent free space and
+     reused, best-fit, by subsequent allocations.
+    The base heap address is 0x69690000.
+    '''
+
+    def __init__(self):
+        self._heap_addr = 0x69690000
+        # maps from VA to size of each live allocation
+        self._allocations = {}
+        # free blocks as (size, VA) tuples, sorted ascending, for best-fit searches
+        self._free = []
+        # maps from start VA to size, and from end VA to start VA, of free blocks,
+        #  for merging neighbors
+        self._free_by_va = {}
+        self._free_by_end = {}
+
+    def allocate(self, emu, size):
+        '''
+        Allocate `size` bytes of address space, reusing freed space when possible.
+        `size` should be a multiple of the page size.
+
+        :type size: int
+        :rtype: int
+        '''
+        i = bisect.bisect_left(self._free, (size, 0))
+        if i < len(self._free):
+            # best fit: the smallest free block that's large enough
+            free_size, va = self._free[i]
+            self._remove_free(free_size, va)
+            if free_size > size:
+                self._add_free(va + size, free_size - size)
+        else:
+            va = self._reserve(emu, size)
+        self._allocations[va] = size
+        return va
+
+    def free(self, va):
+        '''
+        Release the allocation at the given VA, merging it with adjacent free blocks.
+        Returns False if `va` isn't the start of a live allocation from this heap.
+
+        :type va: int
+        :rtype: bool
+        '''
+        size = self._allocations.pop(va, None)
+        if size is None:
+            return False
+
+        next_size = self._free_by_va.get(va + size)
+        if next_size is not None:
+            self._remove_free(next_size, va + size)
+            size += next_size
+
+        prev_va = self._free_by_end.get(va)
+        if prev_va is not None:
+            prev_size = self._free_by_va[prev_va]
+            self._remove_free(prev_size, prev_va)
+            va = prev_va
+            size += prev_size
+
+        self._add_free(va, size)
+        return True
+
+    def _add_free(self, va, size):
+        bisect.insort(self._free, (size, va))
+        self._free_by_va[va] = size
+        self._free_by_end[va + size] = va
+
+    def _remove_free(self, size, va):
+        del self._free[bisect.bisect_left(self._free, (size, va))]
+        del self._free_by_va[va]
+        del self._free_by_end[va + size]
+
+    def _reserve(self, emu, size):
+        '''
+        Reserve `size` bytes of address space that the emulator doesn't map yet.
+        The emulator may already contain heap allocations, e.g. when it's restored
+         from a snapshot or reused across emulation runs, so skip past those.
+
+        :type size: int
+        :rtype: int
+        '''
+        va = self._heap_addr
+        memory_maps = emu.getMemoryMaps()
+        moved = True
+        while moved:
+            moved = False
+            for mva, msize, _, _ in memory_maps:
+                if mva < va + size and va < mva + msize:
+                    va = round(mva + msize, PAGE_SIZE)
+                    moved = True
+        self._heap_addr = round(va + size, PAGE_SIZE)
+        return va
 
 
 class RtlAllocateHeapHook(viv_utils.emulator_drivers.Hook):
     '''
     Hook calls to RtlAllocateHeap, allocate memory in a "heap"
      section, and return pointers to this memory.
-    The base heap address is 0x69690000.
     The max allocation size is 10 MB.
     '''
 
-    def __init__(self, *args, **kwargs):
+    # works for kernel32.HeapAlloc
+    CALLNAMES = frozenset(["ntdll.RtlAllocateHeap"])
+
+    def __init__(self, heap=None, *args, **kwargs):
+        '''
+        :type heap: HeapState
+        :param heap: The heap to allocate from, possibly shared with other hooks.
+         By default, the hook allocates from its own heap.
+        '''
         super(RtlAllocateHeapHook, self).__init__(*args, **kwargs)
-        self._heap_addr = 0x69690000
+        if heap is None:
+            heap = HeapState()
+        self._heap = heap
 
     MAX_ALLOCATION_SIZE = 10 * 1024 * 1024
 
+    HEAP_MEM_NAME = "[heap allocation]"
+
     def _allocate_mem(self, emu, size):
-        size = round(size, 0x1000)
+        # round up to the page size, inlined from `round`
+        size = (size + PAGE_SIZE - 1) & _PAGE_MASK
         if size > self.MAX_ALLOCATION_SIZE:
             size = self.MAX_ALLOCATION_SIZE
-        va = self._heap_addr
-        self.d("RtlAllocateHeap: mapping %s bytes at %s", hex(size), hex(va))
-        emu.addMemoryMap(va, envi.memory.MM_RWX, "[heap allocation]", "\x00" * (size + 4))
-        emu.writeMemory(va, "\x00" * size)
-        self._heap_addr += size
+        # the mapping has four bytes of slack at its end, so reserve an extra page
+        va = self._heap.allocate(emu, size + PAGE_SIZE)
+        self.d("RtlAllocateHeap: mapping 0x%x bytes at 0x%x", size, va)
+        self._map_zeroed(emu, va, size + 4)
         return va
 
+    def _map_zeroed(self, emu, va, size):
+        '''
+        Ensure that a single, zeroed heap mapping of `size` bytes exists at `va`.
+        '''
+        memory_map = emu.getMemoryMap(va)
+        if memory_map is not None and memory_map[0] == va and memory_map[1] == size:
+            # reuse the mapping of a freed allocation of the same size
+            emu.writeMemory(va, "\x00" * size)
+            return
+
+        # the space may have been freed and merged from other allocations,
+        #  so drop their stale mappings first.
+        if any(mname == self.HEAP_MEM_NAME and mva < va + size and va < mva + msize
+               for mva, msize, _, mname in emu.getMemoryMaps()):
+            memory_snap = emu.getMemorySnap()
+            memory_snap = [m for m in memory_snap
+                           if not (m[2][3] == self.HEAP_MEM_NAME and m[0] < va + size and va < m[1])]
+            emu.setMemorySnap(memory_snap)
+
+        # the new mapping is already zeroed, so there's no need to write to it
+        emu.addMemoryMap(va, envi.memory.MM_RWX, self.HEAP_MEM_NAME, "\x00" * size)
+
     def hook(self, callname, driver, callconv, api, argv):
-        # works for kernel32.HeapAlloc
-        if callname == "ntdll.RtlAllocateHeap":
+        if callname in self.CALLNAMES:
             emu = driver
             hheap, flags, size = argv
             va = self._allocate_mem(emu, size)
@@ -200,13 +382,13 @@ class AllocateHeap(RtlAllocateHeapHook):
     Hook calls to AllocateHeap and handle them like calls to RtlAllocateHeapHook.
     '''
 
+    CALLNAMES = frozenset(["kernel32.LocalAlloc", "kernel32.GlobalAlloc", "kernel32.VirtualAlloc"])
+
     def __init__(self, *args, **kwargs):
         super(AllocateHeap, self).__init__(*args, **kwargs)
 
     def hook(self, callname, driver, callconv, api, argv):
-        if callname == "kernel32.LocalAlloc" or \
-           callname == "kernel32.GlobalAlloc" or \
-           callname == "kernel32.VirtualAlloc":
+        if callname in self.CALLNAMES:
             emu = driver
             size = argv[0]
             va = self._allocate_mem(emu, size)
@@ -220,12 +402,13 @@ class MallocHeap(RtlAllocateHeapHook):
     Hook calls to malloc and handle them like calls to RtlAllocateHeapHook.
     '''
 
+    CALLNAMES = frozenset(["msvcrt.malloc", "msvcrt.calloc"])
+
     def __init__(self, *args, **kwargs):
         super(MallocHeap, self).__init__(*args, **kwargs)
 
     def hook(self, callname, driver, callconv, api, argv):
-        if callname == "msvcrt.malloc" or \
-           callname == "msvcrt.calloc":
+        if callname in self.CALLNAMES:
             emu = driver
             size = argv[0]
             va = self._allocate_mem(emu, size)
@@ -234,20 +417,110 @@ class MallocHeap(RtlAllocateHeapHook):
         raise viv_utils.emulator_drivers.UnsupportedFunction()
 
 
+class RtlFreeHeapHook(viv_utils.emulator_drivers.Hook):
+    '''
+    Hook calls to RtlFreeHeap, and release the memory allocated by
+     the allocation hooks that share the heap, so that it can be reused.
+    '''
+
+    # works for kernel32.HeapFree
+    CALLNAMES = frozenset(["ntdll.RtlFreeHeap"])
+
+    def __init__(self, heap, *args, **kwargs):
+        '''
+        :type heap: HeapState
+        :param heap: The heap shared with the allocation hooks.
+        '''
+        super(RtlFreeHeapHook, self).__init__(*args, **kwargs)
+        self._heap = heap
+
+    def _free_mem(self, va):
+        # pointers that weren't allocated from this heap, e.g. those restored
+        #  from a snapshot, are ignored and stay mapped.
+        if self._heap.free(va):
+            self.d("RtlFreeHeap: freed allocation at 0x%x", va)
+
+    def hook(self, callname, driver, callconv, api, argv):
+        if callname in self.CALLNAMES:
+            emu = driver
+            hheap, flags, va = argv
+            self._free_mem(va)
+            callconv.execCallReturn(emu, 1, len(argv))
+            return True
+        raise viv_utils.emulator_drivers.UnsupportedFunction()
+
+
+class FreeHeap(RtlFreeHeapHook):
+    '''
+    Hook calls to LocalFree, GlobalFree, and VirtualFree,
+     and handle them like calls to RtlFreeHeapHook.
+    '''
+
+    CALLNAMES = frozenset(["kernel32.LocalFree", "kernel32.GlobalFree", "kernel32.VirtualFree"])
+
+    MEM_RELEASE = 0x8000
+
+    def __init__(self, *args, **kwargs):
+        super(FreeHeap, self).__init__(*args, **kwargs)
+
+    def hook(self, callname, driver, callconv, api, argv):
+        if callname in self.CALLNAMES:
+            emu = driver
+            va = argv[0]
+            # LocalFree and GlobalFree return NULL on success, VirtualFree returns non-zero
+            if callname == "kernel32.VirtualFree":
+                # only MEM_RELEASE gives up the range. after MEM_DECOMMIT it stays reserved
+                #  and may be recommitted, so it mustn't be handed out again.
+                if argv[2] & self.MEM_RELEASE:
+                    self._free_mem(va)
+                ret = 1
+            else:
+                self._free_mem(va)
+                ret = 0
+            callconv.execCallReturn(emu, ret, len(argv))
+            return True
+        raise viv_utils.emulator_drivers.UnsupportedFunction()
+
+
+class MsvcrtFreeHook(RtlFreeHeapHook):
+    '''
+    Hook calls to free and handle them like calls to RtlFreeHeapHook.
+    '''
+
+    CALLNAMES = frozenset(["msvcrt.free"])
+
+    def __init__(self, *args, **kwargs):
+        super(MsvcrtFreeHook, self).__init__(*args, **kwargs)
+
+    def hook(self, callname, driver, callconv, api, argv):
+        if callname in self.CALLNAMES:
+            emu = driver
+            va = argv[0]
+            self._free_mem(va)
+            callconv.execCallReturn(emu, 0x0, len(argv))
+            return True
+        raise viv_utils.emulator_drivers.UnsupportedFunction()
+
+
 class MemcpyHook(viv_utils.emulator_drivers.Hook):
     '''
     Hook and handle calls to memcpy.
     '''
 
+    CALLNAMES = frozenset(["msvcrt.memcpy"])
+
     def __init__(self, *args, **kwargs):
         super(MemcpyHook, self).__init__(*args, **kwargs)
 
     def hook(self, callname, driver, callconv, api, argv):
-        if callname == "msvcrt.memcpy":
+        if callname in self.CALLNAMES:
             emu = driver
             dst, src, count = argv
-            data = emu.readMemory(src, count)
-            emu.writeMemory(dst, data)
+            # envi memory maps hold immutable strings, so the copy read here is handed
+            #  straight to writeMemory. skip both when there's nothing to move.
+            if count and dst != src:
+                data = emu.readMemory(src, count)
+                emu.writeMemory(dst, data)
             callconv.execCallReturn(emu, 0x0, len(argv))
             return True
 
@@ -259,22 +532,36 @@ class ExitProcessHook(viv_utils.emulator_drivers.Hook):
     Hook calls to ExitProcess and stop emulation when these are hit.
     '''
 
+    CALLNAMES = frozenset(["kernel32.ExitProcess"])
+
     def __init__(self, *args, **kwargs):
         super(ExitProcessHook, self).__init__(*args, **kwargs)
 
     def hook(self, callname, driver, callconv, api, argv):
-        if callname == "kernel32.ExitProcess":
+        if callname in self.CALLNAMES:
             raise viv_utils.emulator_drivers.StopEmulation()
 
 
-DEFAULT_HOOKS = [
-    GetProcessHeapHook(),
-    RtlAllocateHeapHook(),
-    AllocateHeap(),
-    MallocHeap(),
-    ExitProcessHook(),
-    MemcpyHook(),
-]
+class DispatchingHook(viv_utils.emulator_drivers.Hook):
+    '''
+    Hand each call to the hook that handles the called function, found via its CALLNAMES.
+    The driver tries each of its hooks in turn until one handles the call,
+     so a single dispatcher saves a failed (and raising) hook call per other hook.
+    '''
+
+    def __init__(self, hooks, *args, **kwargs):
+        super(DispatchingHook, self).__init__(*args, **kwargs)
+        # maps from call name to the hook that handles it
+        self._hooks_by_callname = {}
+        for hook in hooks:
+            for callname in hook.CALLNAMES:
+                self._hooks_by_callname[callname] = hook
+
+    def hook(self, callname, driver, callconv, api, argv):
+        hook = self._hooks_by_callname.get(callname)
+        if hook is None:
+            raise viv_utils.emulator_drivers.UnsupportedFunction()
+        return hook.hook(callname, driver, callconv, api, argv)
 
 
 @contextlib.contextmanager
@@ -288,10 +575,21 @@ def defaultHooks(driver):
             driver.runFunction()
             ...
     '''
+    # each use gets fresh hooks, with a single heap shared by the allocation hooks
+    heap = HeapState()
+    hook = DispatchingHook([
+        GetProcessHeapHook(),
+        RtlAllocateHeapHook(heap),
+        AllocateHeap(heap),
+        MallocHeap(heap),
+        RtlFreeHeapHook(heap),
+        FreeHeap(heap),
+        MsvcrtFreeHook(heap),
+        ExitProcessHook(),
+        MemcpyHook(),
+    ])
     try:
-        for hook in DEFAULT_HOOKS:
-            driver.add_hook(hook)
+        driver.add_hook(hook)
         yield
     finally:
-        for hook in DEFAULT_HOOKS:
-            driver.remove_hook(hook)
+        driver.remove_hook(hook)
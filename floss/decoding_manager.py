@@ -92,6 +92,9 @@ def emulate_function(emu, function_index, fva, return_address, max_instruction_c
       - RtlAllocateHeap
       - AllocateHeap
       - malloc
+      - RtlFreeHeap
+      - LocalFree, GlobalFree, VirtualFree
+      - free
 
     :type emu: envi.Emulator
     :type function_index: viv_utils.FunctionIndex
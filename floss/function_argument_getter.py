@@ -1,4 +1,5 @@
-from collections import namedtuple
+import logging
+from collections import namedtuple, defaultdict
 
 import viv_utils
 import viv_utils.emulator_drivers
@@ -11,23 +12,29 @@ FunctionContext = namedtuple("FunctionContext", ["emu_snap", "return_address", "
 
 
 class CallMonitor(viv_utils.emulator_drivers.Monitor):
-    """ collect call arguments to a target function during emulation """
-    def __init__(self, vivisect_workspace, target_fva):
-        """ :param target_fva: address of function whose arguments to monitor """
+    """ collect call arguments to target functions during emulation """
+    def __init__(self, vivisect_workspace, target_fvas):
+        """ :param target_fvas: addresses of functions whose arguments to monitor """
         viv_utils.emulator_drivers.Monitor.__init__(self, vivisect_workspace)
-        self.target_function_va = target_fva
-        self.function_contexts = []
+        self.target_function_vas = frozenset(target_fvas)
+        # maps from target function VA to list of FunctionContext
+        self.function_contexts = defaultdict(list)
 
     def apicall(self, emu, op, pc, api, argv):
+        if pc not in self.target_function_vas:
+            return
         return_address = self.getStackValue(emu, 0)
-        if pc == self.target_function_va:
-            self.function_contexts.append(FunctionContext(emu.getEmuSnap(), return_address, op.va))
+        # emulation continues after the call and mutates memory, so the snapshot can't be deferred.
+        # envi shares the (immutable) contents of unmodified memory maps across snapshots, though.
+        self.function_contexts[pc].append(FunctionContext(emu.getEmuSnap(), return_address, op.va))
 
-    def get_contexts(self):
-        return self.function_contexts
+    def get_contexts(self, target_fva):
+        return self.function_contexts.get(target_fva, [])
 
     def prehook(self, emu, op, starteip):
-        self.d("%s: %s", hex(starteip), op)
+        # called for every emulated instruction, so don't format anything unless it's logged
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self.d("%s: %s", hex(starteip), op)
 
 
 class FunctionArgumentGetter(viv_utils.LoggingObject):
@@ -35,28 +42,71 @@ class FunctionArgumentGetter(viv_utils.LoggingObject):
         viv_utils.LoggingObject.__init__(self)
         self.vivisect_workspace = vivisect_workspace
         self.emu = makeEmulator(vivisect_workspace)
+        # the emulator is shared by all callers, so each run starts from this state.
+        # otherwise, writes made while emulating one caller leak into the contexts of the next.
+        # this is cheap: snapshots share the contents of unmodified memory maps.
+        self._initial_emu_snap = self.emu.getEmuSnap()
         self.driver = viv_utils.emulator_drivers.FunctionRunnerEmulatorDriver(self.emu)
         self.index = viv_utils.InstructionFunctionIndex(vivisect_workspace)
+        # maps from function VA to the VAs of the functions that call it
+        self._caller_function_vas_cache = {}
+        # maps from instruction VA to the VA of the function that contains it.
+        # lookups in the InstructionFunctionIndex are relatively expensive.
+        self._function_va_cache = {}
 
     def get_all_function_contexts(self, function_va):
-        self.d("Getting function context for function at 0x%08X...", function_va)
+        return self.get_all_function_contexts_batched([function_va])[function_va]
 
-        all_contexts = []
-        for caller_va in self.get_caller_vas(function_va):
-            function_context = self.get_contexts_via_monitor(caller_va, function_va)
-            all_contexts.extend(function_context)
+    def get_all_function_contexts_batched(self, function_vas):
+        """
+        collect the contexts of calls to all the given functions.
+        each caller is emulated only once, no matter how many of the functions it calls.
 
-        self.d("Got %d function contexts for function at 0x%08X.", len(all_contexts), function_va)
+        :rtype: Mapping[int, Sequence[FunctionContext]]
+        """
+        # maps from caller function VA to the set of given functions that it calls
+        target_fvas_by_caller = defaultdict(set)
+        for function_va in function_vas:
+            self.d("Getting function context for function at 0x%08X...", function_va)
+            for caller_va in self.get_caller_vas(function_va):
+                target_fvas_by_caller[caller_va].add(function_va)
+
+        all_contexts = {function_va: [] for function_va in function_vas}
+        for caller_va, target_fvas in sorted(target_fvas_by_caller.items()):
+            function_contexts = self.get_contexts_via_monitor_batched(caller_va, target_fvas)
+            for target_fva, contexts in function_contexts.items():
+                all_contexts[target_fva].extend(contexts)
+
+        for function_va, contexts in all_contexts.items():
+            self.d("Got %d function contexts for function at 0x%08X.", len(contexts), function_va)
         return all_contexts
 
+    def get_function_va(self, va):
+        '''
+        Get the VA of the function that contains the given instruction VA.
+        Raises KeyError if the VA is not within a known function.
+        '''
+        function_va = self._function_va_cache.get(va)
+        if function_va is None:
+            function_va = self.index[va]
+            self._function_va_cache[va] = function_va
+        return function_va
+
     def get_caller_vas(self, function_va):
+        caller_function_vas = self._caller_function_vas_cache.get(function_va)
+        if caller_function_vas is None:
+            caller_function_vas = self._get_caller_vas(function_va)
+            self._caller_function_vas_cache[function_va] = caller_function_vas
+        return caller_function_vas
+
+    def _get_caller_vas(self, function_va):
         # optimization: avoid re-processing the same function repeatedly
         caller_function_vas = set([])
-        for caller_va in self.vivisect_workspace.getCallers(function_va):
+        for caller_va in set(self.vivisect_workspace.getCallers(function_va)):
             self.d("    caller: %s" % hex(caller_va))
             try:
                 # the address of the function that contains this instruction
-                caller_function_va = self.index[caller_va]
+                caller_function_va = self.get_function_va(caller_va)
             except KeyError:
                 # there's a pointer outside a function, or
                 # maybe two functions share the same basic block.
@@ -66,32 +116,47 @@ class FunctionArgumentGetter(viv_utils.LoggingObject):
 
             self.d("      function: %s" % hex(caller_function_va))
             caller_function_vas.add(caller_function_va)
-        return caller_function_vas
+        return frozenset(caller_function_vas)
 
     def get_contexts_via_monitor(self, fva, target_fva):
         """
         run the given function while collecting arguments to a target function
         """
+        return self.get_contexts_via_monitor_batched(fva, [target_fva])[target_fva]
+
+    def get_contexts_via_monitor_batched(self, fva, target_fvas):
+        """
+        run the given function while collecting arguments to several target functions
+
+        :rtype: Mapping[int, Sequence[FunctionContext]]
+        """
 
         try:
-            self.d("    emulating: %s, watching %s" % (hex(self.index[fva]), hex(target_fva)))
-            monitor = CallMonitor(self.vivisect_workspace, target_fva)
+            function_va = self.get_function_va(fva)
+            self.d("    emulating: %s, watching %s" % (hex(function_va), ", ".join(map(hex, target_fvas))))
+            monitor = CallMonitor(self.vivisect_workspace, target_fvas)
             self.driver.add_monitor(monitor)
 
+            self.emu.setEmuSnap(self._initial_emu_snap)
             with api_hooks.defaultHooks(self.driver):
-                self.driver.runFunction(self.index[fva], maxhit=1, maxrep=0x100, func_only=True)
+                self.driver.runFunction(function_va, maxhit=1, maxrep=0x100, func_only=True)
 
-            contexts = monitor.get_contexts()
+            contexts = {target_fva: monitor.get_contexts(target_fva) for target_fva in target_fvas}
 
         finally:
             self.driver.remove_monitor(monitor)
 
         self.d("      results:")
-        for c in contexts:
-            self.d("        <context>")
+        for target_contexts in contexts.values():
+            for c in target_contexts:
+                self.d("        <context>")
 
         return contexts
 
 
 def get_function_contexts(vw, fva):
     return FunctionArgumentGetter(vw).get_all_function_contexts(fva)
+
+
+def get_function_contexts_batched(vw, fvas):
+    return FunctionArgumentGetter(vw).get_all_function_contexts_batched(fvas)
@@ -51,8 +51,10 @@ def decode_strings(vw, function_index, decoding_functions_candidates):
     """
     decoded_strings = []
     # TODO pass function list instead of identification manager
-    for fva, _ in decoding_functions_candidates.get_top_candidate_functions(10):
-        for ctx in string_decoder.extract_decoding_contexts(vw, fva):
+    fvas = [fva for fva, _ in decoding_functions_candidates.get_top_candidate_functions(10)]
+    function_contexts = string_decoder.extract_decoding_contexts_batched(vw, fvas)
+    for fva in fvas:
+        for ctx in function_contexts[fva]:
             for delta in string_decoder.emulate_decoding_routine(vw, function_index, fva, ctx):
                 for delta_bytes in string_decoder.extract_delta_bytes(delta, ctx.decoded_at_va, fva):
                     for decoded_string in string_decoder.extract_strings(delta_bytes):
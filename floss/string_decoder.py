@@ -5,7 +5,7 @@ import envi.memory
 import strings
 import decoding_manager
 from utils import makeEmulator
-from function_argument_getter import get_function_contexts
+from function_argument_getter import get_function_contexts, get_function_contexts_batched
 from decoding_manager import DecodedString, LocationType
 
 
@@ -27,6 +27,20 @@ def extract_decoding_contexts(vw, function):
     return get_function_contexts(vw, function)
 
 
+def extract_decoding_contexts_batched(vw, functions):
+    '''
+    Extract the CPU and memory contexts of all calls to each of the given functions.
+    Like `extract_decoding_contexts`, but emulates each caller only once,
+     even if it calls more than one of the functions.
+
+    :param vw: The vivisect workspace in which the functions are defined.
+    :type functions: Sequence[int]
+    :param functions: The addresses of the functions whose contexts we'll find.
+    :rtype: Mapping[int, Sequence[function_argument_getter.FunctionContext]]
+    '''
+    return get_function_contexts_batched(vw, functions)
+
+
 def emulate_decoding_routine(vw, function_index, function, context):
     '''
     Emulate a function with a given context and extract the CPU and
@@ -0,0 +1,67 @@
+#include <stdio.h>
+#include <string.h>
+#include <stdint.h>
+#include <stdlib.h>
+
+
+#define SCRATCH_SIZE 0x100
+#define SCRATCH_ROUNDS 8
+
+
+char *decode(const void *in_buf, size_t in_len, unsigned char key) {
+    // allocate two neighboring buffers and free both,
+    // so that their space is merged into a single free block.
+    char *first = malloc(SCRATCH_SIZE);
+    char *second = malloc(SCRATCH_SIZE);
+    if (first == NULL || second == NULL) {
+        free(first);
+        free(second);
+        return NULL;
+    }
+    first[0] = 'A';
+    second[0] = 'B';
+    free(first);
+    free(second);
+
+    // allocate and free a small buffer repeatedly,
+    // splitting the merged block and merging it back each time.
+    for (unsigned int i = 0; i < SCRATCH_ROUNDS; i++) {
+        char *scratch = malloc(SCRATCH_SIZE);
+        if (scratch == NULL) {
+            return NULL;
+        }
+        scratch[0] = (char)i;
+        free(scratch);
+    }
+
+    // the output buffer is larger than either scratch buffer,
+    // so it's carved from the merged block and spans both.
+    char *out_buf = malloc(in_len + 0x1800);
+    if (out_buf == NULL) {
+        return NULL;
+    }
+
+    for (unsigned int i = 0; i < in_len; i++) {
+        out_buf[i] = ((char *)in_buf)[i] ^ key;
+    }
+    if (in_len > 0) {
+        out_buf[in_len - 1] = 0;
+    }
+
+    return out_buf;
+}
+
+
+int main(int argc, char **argv) {
+    char in[] = "idmmn!gsnl!`!sdtrde!id`q!cmnbj";
+    char *out = NULL;
+
+    out = decode(in, sizeof(in), 0x1);
+    if (out == NULL) {
+        perror("failed to decode.\n");
+        return -1;
+    }
+    printf("%s\n", out);
+    free(out);
+    return 0;
+}